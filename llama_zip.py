@@ -1,106 +1,141 @@
 import argparse
+import base64
+import bisect
 import signal
 import string
 import sys
-from collections import deque
 
 import numpy as np
 from llama_cpp import Llama
-from more_itertools import consume
 from tqdm import tqdm
 
 
-NUM_STATE_BITS = 64
-FREQ_SCALE_FACTOR = 1 << 32
+NUM_STATE_BITS = 32
+FREQ_SCALE_FACTOR = 1 << 28
 BASE64 = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
+BASE64_CHARS = frozenset(BASE64)
+BIT_BYTES = (b"\0", b"\1")
+BINARY_DIGITS_TO_BITS = bytes.maketrans(b"01", b"\0\1")
+SEXTET_WEIGHTS = 1 << np.arange(5, -1, -1, dtype=np.uint8)
+SEXTETS_TO_BASE64 = BASE64.encode().ljust(256, b"\0")
+BASE64_TO_SEXTETS = bytes(max(BASE64.find(chr(i)), 0) for i in range(256))
 
 
 class ArithmeticCoderBase:
     def __init__(self):
         full_range = 1 << NUM_STATE_BITS
         self.half_range = full_range >> 1
-        self.quarter_range = self.half_range >> 1
         self.state_mask = full_range - 1
         self.low = 0
         self.high = self.state_mask
 
     def update(self, cum_freqs, symbol):
-        total = int(cum_freqs[-1])
+        total = cum_freqs[-1]
         range = self.high - self.low + 1
-        symhigh = int(cum_freqs[symbol])
+        symhigh = cum_freqs[symbol]
         self.high = self.low + symhigh * range // total - 1
-        symlow = int(cum_freqs[symbol - 1]) if symbol > 0 else 0
+        symlow = cum_freqs[symbol - 1] if symbol > 0 else 0
         self.low = self.low + symlow * range // total
-        while ((self.low ^ self.high) & self.half_range) == 0:
-            self.shift()
-            self.low = (self.low << 1) & self.state_mask
-            self.high = ((self.high << 1) & self.state_mask) | 1
-        while (self.low & ~self.high & self.quarter_range) != 0:
-            self.underflow()
-            self.low = (self.low << 1) ^ self.half_range
-            self.high = ((self.high ^ self.half_range) << 1) | self.half_range | 1
-
-    def shift(self):
+        # leading bits shared by low and high are settled and can be shifted out
+        num_shifts = NUM_STATE_BITS - (self.low ^ self.high).bit_length()
+        if num_shifts:
+            self.shift(num_shifts)
+            self.low = (self.low << num_shifts) & self.state_mask
+            self.high = ((self.high << num_shifts) & self.state_mask) | (
+                (1 << num_shifts) - 1
+            )
+        # count the run of second-highest bits where low is 01... and high is 10...
+        straddling = self.low & ~self.high & (self.half_range - 1)
+        num_underflows = (NUM_STATE_BITS - 1) - (
+            ~straddling & (self.half_range - 1)
+        ).bit_length()
+        if num_underflows:
+            self.underflow(num_underflows)
+            self.low = (self.low << num_underflows) & (self.half_range - 1)
+            self.high = (
+                ((self.high << num_underflows) & (self.half_range - 1))
+                | self.half_range
+                | ((1 << num_underflows) - 1)
+            )
+
+    def shift(self, num_bits):
         raise NotImplementedError()
 
-    def underflow(self):
+    def underflow(self, num_bits):
         raise NotImplementedError()
 
 
 class Encoder(ArithmeticCoderBase):
     def __init__(self):
         super().__init__()
-        self.encoded_data = []
+        self.encoded_data = bytearray()
         self.num_underflow = 0
 
     def get_encoded(self):
-        return self.encoded_data
+        return np.frombuffer(self.encoded_data, dtype=np.uint8)
 
     def encode_symbol(self, cum_freqs, symbol):
-        self.update(cum_freqs, symbol)
+        self.update(memoryview(cum_freqs), symbol)
 
     def finish(self):
         self.encoded_data.append(1)
 
-    def shift(self):
-        bit = self.low >> (NUM_STATE_BITS - 1)
-        self.encoded_data.append(bit)
-        self.encoded_data.extend([bit ^ 1] * self.num_underflow)
+    def shift(self, num_bits):
+        bits = self.low >> (NUM_STATE_BITS - num_bits)
+        first_bit = bits >> (num_bits - 1)
+        self.encoded_data.append(first_bit)
+        self.encoded_data += BIT_BYTES[first_bit ^ 1] * self.num_underflow
         self.num_underflow = 0
+        if num_bits > 1:
+            remaining_bits = bits & ((1 << (num_bits - 1)) - 1)
+            self.encoded_data += (
+                format(remaining_bits, f"0{num_bits - 1}b")
+                .encode()
+                .translate(BINARY_DIGITS_TO_BITS)
+            )
 
-    def underflow(self):
-        self.num_underflow += 1
+    def underflow(self, num_bits):
+        self.num_underflow += num_bits
 
 
 class Decoder(ArithmeticCoderBase):
-    def __init__(self, encoded_data: list):
+    def __init__(self, encoded_data: bytes):
         super().__init__()
-        self.input = deque(encoded_data)
-        self.code = sum(
-            self.read_code_bit() << i for i in range(NUM_STATE_BITS - 1, -1, -1)
-        )
+        self.input = encoded_data
+        self.input_pos = 0
+        self.code = self.read_code_bits(NUM_STATE_BITS)
 
     def decode_symbol(self, cum_freqs):
-        total = int(cum_freqs[-1])
+        cum_freqs = memoryview(cum_freqs)
+        total = cum_freqs[-1]
         range = self.high - self.low + 1
         offset = self.code - self.low
         value = ((offset + 1) * total - 1) // range
-        symbol = np.searchsorted(cum_freqs, value, side="right")
+        symbol = bisect.bisect_right(cum_freqs, value)
         self.update(cum_freqs, symbol)
         return symbol
 
-    def shift(self):
-        self.code = ((self.code << 1) & self.state_mask) | self.read_code_bit()
+    def shift(self, num_bits):
+        self.code = ((self.code << num_bits) & self.state_mask) | self.read_code_bits(
+            num_bits
+        )
 
-    def underflow(self):
+    def underflow(self, num_bits):
         self.code = (
             (self.code & self.half_range)
-            | ((self.code << 1) & (self.state_mask >> 1))
-            | self.read_code_bit()
+            | ((self.code << num_bits) & (self.state_mask >> 1))
+            | self.read_code_bits(num_bits)
         )
 
-    def read_code_bit(self):
-        return self.input.popleft() if len(self.input) else 0
+    def read_code_bits(self, num_bits):
+        start = self.input_pos >> 3
+        end = (self.input_pos + num_bits + 7) >> 3
+        window = self.input[start:end]
+        # bits past the end of the input read as zeros
+        value = int.from_bytes(window, "big") << (8 * (end - start - len(window)))
+        unused_bits = 8 * (end - start) - (self.input_pos & 7) - num_bits
+        self.input_pos += num_bits
+        return (value >> unused_bits) & ((1 << num_bits) - 1)
 
 
 class LlamaZip:
@@ -126,6 +161,12 @@ class LlamaZip:
             n_ctx=n_ctx,
             verbose=False,
         )
+        self.bos_token = self.model.token_bos()
+        self.n_ctx = self.model.n_ctx()
+        self.adds_space_prefix = self.tokenizer_adds_space_prefix()
+        n_vocab = self.model.n_vocab()
+        self.freqs_buffer = np.empty(n_vocab, dtype=np.float32)
+        self.cum_freqs_buffer = np.empty(n_vocab, dtype=np.uint32)
         if self.verbose:
             print(
                 "\r" + " " * len(loading_message) + "\r",
@@ -135,50 +176,61 @@ class LlamaZip:
             )
 
     def compute_cdf(self, logits):
-        logprobs = self.model.logits_to_logprobs(logits)
-        probs = np.exp(logprobs)
-        freqs = np.maximum(1, np.round(FREQ_SCALE_FACTOR * probs))
-        cum_freqs = np.cumsum(freqs)
-        return cum_freqs
+        # reuses the same buffers for every token to avoid vocab-sized temporaries
+        freqs = self.freqs_buffer
+        np.subtract(logits, np.max(logits), out=freqs)
+        np.exp(freqs, out=freqs)
+        np.multiply(freqs, FREQ_SCALE_FACTOR / np.sum(freqs), out=freqs)
+        np.rint(freqs, out=freqs)
+        np.maximum(freqs, 1, out=freqs)
+        cum_freqs = self.cum_freqs_buffer
+        cum_freqs[:] = freqs
+        return np.cumsum(cum_freqs, out=cum_freqs)
+
+    def next_token_logits(self, tokens, num_known, window_overlap):
+        if self.model.n_tokens == self.n_ctx and window_overlap > 0:
+            self.slide_window(window_overlap - 1)
+        if self.model.n_tokens in (0, self.n_ctx):
+            # the window is empty or full, so refill it with the last overlap tokens
+            start_idx = max(0, num_known - window_overlap)
+            self.model.reset()
+            self.model.eval([self.bos_token] + tokens[start_idx:num_known])
+        else:
+            self.model.eval([tokens[num_known - 1]])
+        return self.model.scores[self.model.n_tokens - 1]
+
+    def slide_window(self, num_kept):
+        # evict the oldest tokens after BOS from the KV cache and shift the last
+        # num_kept tokens down in place, rather than re-evaluating them
+        num_dropped = self.n_ctx - 1 - num_kept
+        self.model._ctx.kv_cache_seq_rm(0, 1, 1 + num_dropped)
+        self.model._ctx.kv_cache_seq_shift(0, 1 + num_dropped, -1, -num_dropped)
+        input_ids = self.model.input_ids
+        input_ids[1 : 1 + num_kept] = input_ids[1 + num_dropped : self.n_ctx]
+        self.model.n_tokens = 1 + num_kept
 
     def compress(self, uncompressed, window_overlap=0):
+        def length_to_base64(length):
+            # little-endian groups of 5 bits; the sextet's top bit marks continuation
+            chars = []
+            while length >= 32:
+                chars.append(BASE64[32 | (length & 31)])
+                length >>= 5
+            chars.append(BASE64[length])
+            return "".join(chars)
+
         def bits_to_base64(bits):
-            while bits and bits[-1] == 0:
-                bits.pop()
-            while len(bits) % 6 != 0:
-                bits.append(0)
-            return "".join(
-                BASE64[int("".join(str(bit) for bit in bits[i : i + 6]), 2)]
-                for i in range(0, len(bits), 6)
-            )
+            bits = np.trim_zeros(np.asarray(bits, dtype=np.uint8), "b")
+            bits = np.pad(bits, (0, -len(bits) % 6))
+            sextets = bits.reshape(-1, 6) @ SEXTET_WEIGHTS
+            return sextets.tobytes().translate(SEXTETS_TO_BASE64).decode()
 
         def sigint_handler(*_):
             nonlocal interrupted
             interrupted = True
 
-        def process_logits(_, logits):
-            nonlocal next_token_idx
-            if interrupted and next_token_idx < len(tokens) - 1:
-                next_token_idx = len(tokens) - 1
-                if self.verbose:
-                    print(file=sys.stderr)
-            next_token = tokens[next_token_idx]
-            next_token_idx += 1
-            cdf = self.compute_cdf(logits)
-            encoder.encode_symbol(cdf, next_token)
-            progress_bar.update()
-            logits[next_token] = np.inf
-            return logits
-
-        def should_stop(tokens_so_far, logits):
-            return (
-                np.argmax(logits) == self.model.token_eos()
-                or len(tokens_so_far) == self.model.n_ctx()
-            )
-
         self.model.reset()
         tokens = self.model.tokenize(uncompressed.encode("utf-8"), add_bos=False)
-        tokens.append(self.model.token_eos())
         next_token_idx = 0
         encoder = Encoder()
 
@@ -195,20 +247,20 @@ class LlamaZip:
             disable=not self.verbose,
         )
 
-        while next_token_idx < len(tokens):
-            start_idx = max(0, next_token_idx - window_overlap)
-            consume(
-                self.model.generate(
-                    tokens=[self.model.token_bos()] + tokens[start_idx:next_token_idx],
-                    temp=0.0,
-                    logits_processor=process_logits,
-                    stopping_criteria=should_stop,
-                )
-            )
+        while next_token_idx < len(tokens) and not interrupted:
+            logits = self.next_token_logits(tokens, next_token_idx, window_overlap)
+            cdf = self.compute_cdf(logits)
+            encoder.encode_symbol(cdf, tokens[next_token_idx])
+            next_token_idx += 1
+            progress_bar.update()
         progress_bar.close()
+        if interrupted and next_token_idx < len(tokens) and self.verbose:
+            print(file=sys.stderr)
 
         encoder.finish()
-        compressed = bits_to_base64(encoder.get_encoded())
+        compressed = length_to_base64(next_token_idx) + bits_to_base64(
+            encoder.get_encoded()
+        )
         if self.verbose:
             print(compressed, end="", flush=True)
 
@@ -223,21 +275,35 @@ class LlamaZip:
         return self.model.detokenize(tokenized) == double_space
 
     def decompress(self, compressed, window_overlap=0):
-        def base64_to_bits(string):
-            bits = [int(bit) for char in string for bit in f"{BASE64.index(char):06b}"]
-            return bits
+        def split_length(string):
+            if not BASE64_CHARS.issuperset(string):
+                raise ValueError("invalid compressed string")
+            length = 0
+            for i, sextet in enumerate(string.encode().translate(BASE64_TO_SEXTETS)):
+                length |= (sextet & 31) << (5 * i)
+                if not sextet & 32:
+                    return length, string[i + 1 :]
+            return length, ""
+
+        def base64_to_bytes(string):
+            # pad with zero sextets so the length is a whole number of base64 quads
+            return base64.b64decode(string + "A" * (-len(string) % 4), validate=True)
 
-        def process_logits(_, logits):
+        self.model.reset()
+        tokens = []
+        decompressed = bytearray()
+        num_tokens, compressed = split_length(compressed)
+        encoded = base64_to_bytes(compressed)
+        decoder = Decoder(encoded)
+        while len(tokens) < num_tokens:
+            logits = self.next_token_logits(tokens, len(tokens), window_overlap)
             cdf = self.compute_cdf(logits)
             next_token = decoder.decode_symbol(cdf)
-            logits[next_token] = np.inf
-            if next_token == self.model.token_eos():
-                return logits
             detokenized = self.model.detokenize([next_token])
             if (
                 len(tokens) == 0
                 and detokenized.startswith(b" ")
-                and self.tokenizer_adds_space_prefix()
+                and self.adds_space_prefix
             ):
                 detokenized = detokenized[1:]
             tokens.append(next_token)
@@ -245,30 +311,6 @@ class LlamaZip:
             if self.verbose:
                 sys.stdout.buffer.write(detokenized)
                 sys.stdout.buffer.flush()
-            return logits
-
-        def should_stop(tokens_so_far, logits):
-            nonlocal done
-            if np.argmax(logits) == self.model.token_eos():
-                done = True
-            return done or len(tokens_so_far) == self.model.n_ctx()
-
-        self.model.reset()
-        tokens = []
-        decompressed = bytearray()
-        encoded = base64_to_bits(compressed)
-        decoder = Decoder(encoded)
-        done = False
-        while not done:
-            start_idx = max(0, len(tokens) - window_overlap)
-            consume(
-                self.model.generate(
-                    tokens=[self.model.token_bos()] + tokens[start_idx:],
-                    temp=0.0,
-                    logits_processor=process_logits,
-                    stopping_criteria=should_stop,
-                )
-            )
         return decompressed.decode("utf-8")
 
 
@@ -345,14 +387,14 @@ def main():
             percent = float(args.overlap[:-1])
             if not (0 <= percent <= 100):
                 parser.error("window overlap must be in the range [0%, 100%]")
-            window_overlap = int(percent / 100 * (compressor.model.n_ctx() - 1))
+            window_overlap = int(percent / 100 * (compressor.n_ctx - 1))
         else:
             window_overlap = int(args.overlap)
             if window_overlap < 0:
-                window_overlap += compressor.model.n_ctx()
-            if not (0 <= window_overlap < compressor.model.n_ctx()):
+                window_overlap += compressor.n_ctx
+            if not (0 <= window_overlap < compressor.n_ctx):
                 parser.error(
-                    f"window overlap must be in the range [{-compressor.model.n_ctx()}, {compressor.model.n_ctx() - 1}]"
+                    f"window overlap must be in the range [{-compressor.n_ctx}, {compressor.n_ctx - 1}]"
                 )
     except ValueError:
         parser.error(
@@ -367,13 +409,13 @@ def main():
             compressed = (
                 args.compressed[0] if args.compressed else sys.stdin.read().strip()
             )
-            if not all(char in BASE64 for char in compressed):
+            if not BASE64_CHARS.issuperset(compressed):
                 parser.error("invalid compressed string")
             compressor.decompress(compressed, window_overlap)
         elif args.interactive:
             while True:
                 string = input("≥≥≥ ")
-                if string and all(char in BASE64 for char in string):
+                if string and BASE64_CHARS.issuperset(string):
                     try:
                         compressor.decompress(string, window_overlap)
                     except KeyboardInterrupt: